@@ -1,9 +1,11 @@
-import os, re, json, base64, mimetypes, logging, requests, tempfile
+import os, re, base64, logging, requests, asyncio, functools, threading
+from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
-from openpyxl import Workbook  # 仅作为ExcelWriter引擎依赖
+from requests.adapters import HTTPAdapter
+import orjson
 
 from telegram import Update
 from telegram.ext import ApplicationBuilder, MessageHandler, filters, ContextTypes, CommandHandler
@@ -11,14 +13,22 @@ from telegram.ext import ApplicationBuilder, MessageHandler, filters, ContextTyp
 # 报表依赖
 import pandas as pd
 import matplotlib
+matplotlib.use("Agg")  # 只输出图片文件，不需要 GUI 后端
 import matplotlib.pyplot as plt
 from matplotlib import font_manager as fm
 
 # Mongo
 from pymongo import MongoClient, ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError
 from bson import ObjectId
 from bson.errors import InvalidId
 
+# 关键词匹配加速（可选依赖 pyahocorasick；缺失时回退逐个关键词扫描）
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # ================= 基础配置 =================
 load_dotenv()
 
@@ -43,6 +53,10 @@ if _allowed_raw:
             pass
 ALLOWED_USER_IDS = _allowed
 
+# 时区对象只构造一次，各处直接复用
+_TZ_SH = ZoneInfo("Asia/Shanghai")
+_TZ_UTC = ZoneInfo("UTC")
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("tele-qwen-monthly")
 
@@ -63,6 +77,24 @@ CATEGORY_KEYWORDS = {
     "生活缴费": ["水费", "电费", "燃气", "物业", "停车费", "供暖", "生活缴费"],
 }
 CATEGORY_PRIORITY = ["转账", "生活缴费", "出行", "餐饮", "购物", "数码", "娱乐", "通讯", "医疗"]
+# 关键词是静态的，导入时统一转小写
+_CATEGORY_KEYWORDS_LC = {cat: [kw.lower() for kw in kws] for cat, kws in CATEGORY_KEYWORDS.items()}
+
+def _build_keyword_automaton():
+    """把全部关键词（小写）编进一个 Aho–Corasick 自动机，一次扫描即可得到命中的类别"""
+    if ahocorasick is None:
+        return None
+    kw_cats = {}
+    for cat, kws in _CATEGORY_KEYWORDS_LC.items():
+        for kw in kws:
+            kw_cats.setdefault(kw, set()).add(cat)
+    ac = ahocorasick.Automaton()
+    for kw, cats in kw_cats.items():
+        ac.add_word(kw, tuple(cats))
+    ac.make_automaton()
+    return ac
+
+_KEYWORD_AC = _build_keyword_automaton()
 
 # ================= Matplotlib 中文字体设置 =================
 def setup_chinese_font():
@@ -88,20 +120,38 @@ def setup_chinese_font():
         logger.warning("未找到中文字体，图像可能出现乱码。建议安装 Noto/思源黑体。")
     matplotlib.rcParams["axes.unicode_minus"] = False
 
+# ================= 预编译正则 =================
+_NUM_RE = re.compile(r"(-?\d+(?:\.\d+)?)")
+_AMOUNT_RE = re.compile(r"(-?\d+(?:[.,]\d+)?)(?:\s*(?:元|块|rmb|cny|￥))?", re.I)
+_HM_RE = re.compile(r"(\d{1,2}:\d{2})")
+_YM_RE = re.compile(r"\d{4}-\d{2}")
+_PAYEE_RE = re.compile(r"[在于去给向]([\u4e00-\u9fa5A-Za-z0-9_\-·]{2,20})")
+_CN_RE = re.compile(r"([\u4e00-\u9fa5A-Za-z]{2,20})")
+# 商家里混入数字或“花了/付了”等动词时，说明 _PAYEE_RE 吞掉了后半句，启发式结果不可信
+_PAYEE_NOISE_RE = re.compile(r"\d|花了|付了|买了|花费|消费")
+_KV_RE = re.compile(r'(\w+)=(".*?"|\'.*?\'|[^\s]+)')
+_JSON_FENCED_RE = re.compile(r"```json\s*(\{.*?\})\s*```", re.DOTALL)
+_JSON_BRACE_RE = re.compile(r"(\{.*?\})", re.DOTALL)
+
 # ================= 工具函数 =================
-def encode_image_base64(image_path: str) -> str:
-    with open(image_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+def encode_image_data_url(image_bytes: bytes, mime_type: str) -> str:
+    # 从原始字节编码并拼出 data URL（请求体随后由 orjson 一次序列化）
+    b64 = base64.b64encode(image_bytes)
+    return "data:" + (mime_type or "image/jpeg") + ";base64," + b64.decode("ascii")
 
 def clean_amount(raw) -> float:
     if raw is None:
         return 0.0
     if isinstance(raw, (int, float)):
         return float(raw)
-    s = str(raw)
+    return _clean_amount_str(str(raw))
+
+# 金额格式与商家名高度重复，纯函数结果直接缓存
+@functools.lru_cache(maxsize=4096)
+def _clean_amount_str(s: str) -> float:
     s = s.replace("￥", "").replace("元", "").replace("RMB", "").replace("CNY", "").strip()
     s = s.replace(",", "")
-    m = re.search(r"(-?\d+(?:\.\d+)?)", s)
+    m = _NUM_RE.search(s)
     if not m:
         return 0.0
     try:
@@ -109,19 +159,24 @@ def clean_amount(raw) -> float:
     except:
         return 0.0
 
+@functools.lru_cache(maxsize=4096)
 def pick_category(payee: str = "", desc: str = "", hint: str = "") -> str:
+    # 通义返回的类别提示通常就是类别名本身，命中即返回，省去关键词扫描
+    if hint:
+        for cat in CATEGORY_PRIORITY:
+            if cat in hint:
+                return cat
     text = f"{payee} {desc} {hint}".lower()
     hits = set()
-    for cat, kws in CATEGORY_KEYWORDS.items():
-        for kw in kws:
-            if kw.lower() in text:
-                hits.add(cat)
-                break
-    if not hits and hint:
-        for cat in CATEGORY_KEYWORDS.keys():
-            if cat in hint:
-                hits.add(cat)
-                break
+    if _KEYWORD_AC is not None:
+        for _end, cats in _KEYWORD_AC.iter(text):
+            hits.update(cats)
+    else:
+        for cat, kws in _CATEGORY_KEYWORDS_LC.items():
+            for kw in kws:
+                if kw in text:
+                    hits.add(cat)
+                    break
     if not hits:
         if any(x in text for x in ["转账", "收款", "待确认"]):
             return "转账"
@@ -133,9 +188,8 @@ def pick_category(payee: str = "", desc: str = "", hint: str = "") -> str:
 
 def time_today_shanghai(raw_time: str) -> str:
     raw_time = (raw_time or "").strip()
-    m = re.search(r"(\d{1,2}:\d{2})", raw_time)
-    tz = ZoneInfo("Asia/Shanghai")
-    now_tz = datetime.now(tz)
+    m = _HM_RE.search(raw_time)
+    now_tz = datetime.now(_TZ_SH)
     today = now_tz.strftime("%Y-%m-%d")
     hm = m.group(1) if m else now_tz.strftime("%H:%M")
     return f"{today} {hm}"
@@ -145,9 +199,8 @@ def local_to_utc_dt(time_local_str: str):
     输入: 'YYYY-MM-DD HH:MM'（Asia/Shanghai）
     返回: (dt_local[带tz], dt_utc[带tz])
     """
-    tz_sh = ZoneInfo("Asia/Shanghai")
-    dt_local = datetime.strptime(time_local_str, "%Y-%m-%d %H:%M").replace(tzinfo=tz_sh)
-    dt_utc = dt_local.astimezone(ZoneInfo("UTC"))
+    dt_local = datetime.strptime(time_local_str, "%Y-%m-%d %H:%M").replace(tzinfo=_TZ_SH)
+    dt_utc = dt_local.astimezone(_TZ_UTC)
     return dt_local, dt_utc
 
 def fmt_doc_line(doc) -> str:
@@ -162,16 +215,15 @@ def quote_for_kv(val: str) -> str:
     - 普通含空格值默认用双引号包裹。
     """
     s = str(val or "")
+    # 常见情况：不含任何引号，直接统一双引号包裹，便于复制
+    if '"' not in s and "'" not in s:
+        return f"\"{s}\""
     if '"' in s and "'" not in s:
         return f"'{s}'"
     if "'" in s and '"' not in s:
         return f"\"{s}\""
-    if "'" in s and '"' in s:
-        s = s.replace('"', '\\"')
-        return f"\"{s}\""
-    if re.search(r"\s", s):
-        return f"\"{s}\""
-    return f"\"{s}\""  # 统一双引号，便于复制
+    s = s.replace('"', '\\"')
+    return f"\"{s}\""
 
 # ================= 授权 =================
 def ensure_allowed(update: Update) -> bool:
@@ -190,16 +242,98 @@ def ensure_allowed(update: Update) -> bool:
     return True
 
 # ================= Mongo 层 =================
+# 进程内复用同一个 MongoClient（自带连接池），索引只在首次连接时确保一次
+_MONGO_COL = None
+
 def get_mongo():
-    client = MongoClient(MONGO_URI, tz_aware=True)
-    db = client.get_database("tele_finance")
-    col = db.get_collection("expenses")
-    col.create_index([("chat_id", ASCENDING), ("ym", ASCENDING), ("ts_utc", ASCENDING)])
-    return col
+    global _MONGO_COL
+    if _MONGO_COL is None:
+        client = MongoClient(MONGO_URI, tz_aware=True, maxPoolSize=20)
+        db = client.get_database("tele_finance")
+        col = db.get_collection("expenses")
+        col.create_index([("chat_id", ASCENDING), ("ym", ASCENDING), ("ts_utc", ASCENDING)], background=True)
+        backfill_legacy_chat_id(col)
+        _MONGO_COL = col
+    return _MONGO_COL
+
+def _legacy_owner_chat_id():
+    # 历史记录的归属：优先 FORCE_CHAT_ID，否则为唯一的授权用户
+    raw = (os.getenv("FORCE_CHAT_ID") or "").strip()
+    if raw:
+        try:
+            return int(raw)
+        except ValueError:
+            pass
+    if len(ALLOWED_USER_IDS) == 1:
+        return next(iter(ALLOWED_USER_IDS))
+    return None
+
+def chat_filter(chat_id: int) -> dict:
+    """
+    按 chat 过滤的条件：本 chat 的记录 + 缺少 chat_id 的记录（Web 端未设置 FORCE_CHAT_ID 时仍会写入这类记录）。
+    用 $in 而不是 $or/$exists，chat_id 上的复合索引可直接按两个区间扫描。
+    """
+    return {"$in": [chat_id, None]}
+
+def backfill_legacy_chat_id(col):
+    """
+    启动时把已有的缺少 chat_id 的记录归属到 owner chat。
+    之后新写入的此类记录由 chat_filter 兼容，无需重启即可看到。
+    """
+    owner = _legacy_owner_chat_id()
+    if owner is None:
+        return
+    res = col.update_many({"chat_id": {"$exists": False}}, {"$set": {"chat_id": owner}})
+    if res.modified_count:
+        logger.info("已为 %d 条历史记录补齐 chat_id=%s", res.modified_count, owner)
+
+# ===== 批量写入缓冲（group commit）=====
+# 某 chat 没有写入在进行时，新记录立即写入；写入进行期间到达的记录（如连续转发多张截图）
+# 先排队，等上一次写入返回后合并为一次 insert_many（每批最多 INSERT_BATCH_MAX 条）
+INSERT_BATCH_MAX = 50
+_PENDING = defaultdict(list)   # chat_id -> [(doc, future), ...]
+_FLUSH_TASKS = {}              # chat_id -> 正在写入的任务
+
+async def _write_batch(col, batch):
+    failed = {}
+    try:
+        await asyncio.to_thread(col.insert_many, [doc for doc, _fut in batch], ordered=False)
+    except BulkWriteError as e:
+        # ordered=False 时其余文档照常写入，只标记失败的那几条
+        for err in e.details.get("writeErrors", []):
+            failed[err["index"]] = err.get("errmsg", "write error")
+    except Exception as e:
+        for _doc, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+    for i, (_doc, fut) in enumerate(batch):
+        if fut.done():
+            continue
+        if i in failed:
+            fut.set_exception(RuntimeError(f"入库失败：{failed[i]}"))
+        else:
+            fut.set_result(None)
 
-def insert_expense(col, amount: float, category: str, payee: str, time_local_str: str, chat_id: int):
+async def _drain_pending(col, chat_id: int):
+    batch = []
+    try:
+        pending = _PENDING[chat_id]
+        while pending:
+            batch = pending[:INSERT_BATCH_MAX]
+            del pending[:INSERT_BATCH_MAX]
+            await _write_batch(col, batch)
+    finally:
+        # 任务被取消等异常退出时，正在写入的批次和排队中的记录都要有结果，不让 handler 永远等待
+        for _doc, fut in batch + _PENDING.pop(chat_id, []):
+            if not fut.done():
+                fut.set_exception(RuntimeError("入库任务中断"))
+        _FLUSH_TASKS.pop(chat_id, None)
+
+async def insert_expense(col, amount: float, category: str, payee: str, time_local_str: str, chat_id: int):
     dt_local, dt_utc = local_to_utc_dt(time_local_str)
     doc = {
+        "_id": ObjectId(),              # 客户端生成，回显 /edit 片段无需等待服务端
         "chat_id": chat_id,
         "amount": float(amount),
         "category": category,
@@ -208,33 +342,74 @@ def insert_expense(col, amount: float, category: str, payee: str, time_local_str
         "ym": time_local_str[:7],       # 月份分区
         "ts_utc": dt_utc,               # UTC 存库
         "tz": "Asia/Shanghai",
-        "created_at_utc": datetime.now(ZoneInfo("UTC"))
+        "created_at_utc": datetime.now(_TZ_UTC)
     }
-    res = col.insert_one(doc)
-    doc["_id"] = res.inserted_id   # 确保能拿到 _id
+    fut = asyncio.get_running_loop().create_future()
+    _PENDING[chat_id].append((doc, fut))
+    if chat_id not in _FLUSH_TASKS:
+        _FLUSH_TASKS[chat_id] = asyncio.create_task(_drain_pending(col, chat_id))
+    # 等所在批次写入确认后再返回，保证回复“✅”时记录已落库
+    await fut
     return doc
 
 def load_month_df(col, month_arg: str, chat_id: int) -> pd.DataFrame:
-    # 兼容历史没有 chat_id 的旧数据：同时取本 chat 和 chat_id 缺失的记录
+    # 只投影报表需要的字段，减少传输量；按 (chat_id, ym, ts_utc) 索引定位
     cur = col.find(
-        {"ym": month_arg, "$or": [{"chat_id": chat_id}, {"chat_id": {"$exists": False}}]},
-        projection={"_id": 0, "amount": 1, "category": 1, "payee": 1, "time_local": 1}
+        {"chat_id": chat_filter(chat_id), "ym": month_arg},
+        projection={"_id": 0, "amount": 1, "category": 1, "payee": 1, "ts_utc": 1}
     )
-    rows = list(cur)
-    if not rows:
+    # 按列收集后一次性构造 DataFrame；ts_utc 本身就是 datetime，无需再解析字符串
+    times, amounts, categories, payees = [], [], [], []
+    for r in cur:
+        times.append(r.get("ts_utc"))
+        amounts.append(r.get("amount"))
+        categories.append(r.get("category"))
+        payees.append(r.get("payee"))
+    if not times:
         return pd.DataFrame(columns=["Time", "Amount", "Category", "Payee"])
-    df = pd.DataFrame(rows).rename(columns={
-        "time_local": "Time",
-        "amount": "Amount",
-        "category": "Category",
-        "payee": "Payee"
+    return pd.DataFrame({
+        "Time": pd.to_datetime(times, utc=True).tz_convert(_TZ_SH),
+        "Amount": pd.to_numeric(pd.Series(amounts), errors="coerce").fillna(0),
+        "Category": categories,
+        "Payee": payees,
     })
-    df["Time"] = pd.to_datetime(df["Time"], format="%Y-%m-%d %H:%M", errors="coerce")
-    df["Amount"] = pd.to_numeric(df["Amount"], errors="coerce").fillna(0)
-    df = df.dropna(subset=["Time"]).copy()
-    return df
+
+def _sum_series(rows, index_name: str) -> pd.Series:
+    ser = pd.Series({r["_id"]: r["sum"] for r in rows}, dtype="float64", name="sum")
+    ser.index.name = index_name
+    return ser
+
+def load_month_summary(col, month_arg: str, chat_id: int):
+    """
+    在 Mongo 端一次性聚合当月合计，只回传汇总行。
+    返回: (按类别, 按日期, 按商家) 三个 Series；当月无记录时均为空。
+    """
+    pipeline = [
+        {"$match": {"chat_id": chat_filter(chat_id), "ym": month_arg}},
+        {"$facet": {
+            "byCat": [{"$group": {"_id": "$category", "sum": {"$sum": "$amount"}}}],
+            "byDay": [{"$group": {
+                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$ts_utc", "timezone": "Asia/Shanghai"}},
+                "sum": {"$sum": "$amount"},
+            }}],
+            "byPayee": [{"$group": {"_id": "$payee", "sum": {"$sum": "$amount"}}}],
+        }},
+    ]
+    res = next(col.aggregate(pipeline), None) or {}
+    cat = _sum_series(res.get("byCat", []), "Category").sort_values(ascending=False)
+    daily = _sum_series(res.get("byDay", []), "Time")
+    daily.index = pd.to_datetime(daily.index, format="%Y-%m-%d", errors="coerce")
+    daily = daily[daily.index.notna()].sort_index()
+    daily.index = daily.index.date
+    daily.index.name = "Time"
+    payee = _sum_series(res.get("byPayee", []), "Payee").sort_values(ascending=False)
+    return cat, daily, payee
 
 # ================= 通义 API =================
+# 进程级复用的 HTTP 会话：保持与 DashScope 的长连接，避免每次请求重新握手 TLS
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
 def extract_json_from_qwen(result_text):
     if isinstance(result_text, list):
         try:
@@ -242,24 +417,23 @@ def extract_json_from_qwen(result_text):
         except Exception:
             result_text = str(result_text)
 
-    m = re.search(r"```json\s*(\{.*?\})\s*```", result_text, re.DOTALL)
+    m = _JSON_FENCED_RE.search(result_text)
     if m:
-        return json.loads(m.group(1))
+        return orjson.loads(m.group(1))
 
-    m = re.search(r"(\{.*?\})", result_text, re.DOTALL)
+    m = _JSON_BRACE_RE.search(result_text)
     if m:
-        return json.loads(m.group(1))
+        return orjson.loads(m.group(1))
 
     try:
-        return json.loads(result_text)
+        return orjson.loads(result_text)
     except Exception:
         pass
 
     raise ValueError("未能从通义响应中提取 JSON")
 
-async def call_qwen(image_path: str):
-    mime_type, _ = mimetypes.guess_type(image_path)
-    data_url = f"data:{mime_type};base64,{encode_image_base64(image_path)}"
+async def call_qwen(image_bytes: bytes, mime_type: str = "image/jpeg"):
+    data_url = encode_image_data_url(image_bytes, mime_type)
 
     headers = {
         "Authorization": f"Bearer {DASHSCOPE_API_KEY}",
@@ -288,9 +462,10 @@ async def call_qwen(image_path: str):
     }
 
     url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/multimodal-generation/generation"
-    r = requests.post(url, headers=headers, json=payload, timeout=60)
+    # 请求体含整张图片的 base64，用 orjson 一次序列化为 bytes 直接发送
+    r = await asyncio.to_thread(_SESSION.post, url, headers=headers, data=orjson.dumps(payload), timeout=60)
     r.raise_for_status()
-    result = r.json()
+    result = orjson.loads(r.content)
     if "output" not in result:
         raise RuntimeError(result.get("code", "Unknown"), result.get("message", "No message"))
     content = result["output"]["choices"][0]["message"]["content"]
@@ -306,20 +481,16 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not ensure_allowed(update):
         return
 
-    # 下载到临时文件，处理完立即删除
-    local_tmp = tempfile.NamedTemporaryFile(prefix="screenshot_", suffix=".jpg", delete=False)
-    local_path = local_tmp.name
-    local_tmp.close()
-
     try:
+        # 截图直接下载到内存，不落盘
         photo = update.message.photo[-1]
         tf = await context.bot.get_file(photo.file_id)
-        await tf.download_to_drive(local_path)
+        image_bytes = await tf.download_as_bytearray()
 
-        qwen_resp = await call_qwen(local_path)
+        qwen_resp = await call_qwen(image_bytes, mime_type="image/jpeg")
         data = extract_json_from_qwen(qwen_resp)
         try:
-            logger.info("Parsed (image) data: %s", json.dumps(data, ensure_ascii=False))
+            logger.info("Parsed (image) data: %s", orjson.dumps(data).decode("utf-8"))
         except Exception:
             pass
 
@@ -341,7 +512,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # 入库（按 chat 维度）
         chat_id = update.effective_chat.id
         col = get_mongo()
-        doc = insert_expense(col, amount, category, payee, time_str, chat_id=chat_id)
+        doc = await insert_expense(col, amount, category, payee, time_str, chat_id=chat_id)
 
         # ===== 回复处理方式 + 可直接复制到 /edit 的消息 =====
         await update.message.reply_text("✅ 使用方式：图片识别（AI）")
@@ -353,15 +524,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.exception("处理失败")
         await update.message.reply_text(f"❌ 处理失败：{e}")
 
-    finally:
-        # 自动删除截图
-        try:
-            if os.path.exists(local_path):
-                os.remove(local_path)
-        except Exception:
-            pass
-
-# ===== 文本入账（AI 优先）=====
+# ===== 文本入账（启发式优先，不明确时调用 AI）=====
 # 通过通义千问文本模型从自由文本中抽取结构化字段，仅返回 JSON
 def call_qwen_text(text: str) -> dict:
     headers = {
@@ -386,7 +549,7 @@ def call_qwen_text(text: str) -> dict:
     except Exception:
         pass
     url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
-    r = requests.post(url, headers=headers, json=payload, timeout=60)
+    r = _SESSION.post(url, headers=headers, data=orjson.dumps(payload), timeout=60)
     try:
         r.raise_for_status()
     except requests.HTTPError as e:
@@ -396,7 +559,7 @@ def call_qwen_text(text: str) -> dict:
         except Exception:
             detail = str(e)
         raise RuntimeError(f"DashScope text gen error: {r.status_code} {detail}")
-    result = r.json()
+    result = orjson.loads(r.content)
     if "output" not in result and "output_text" not in result:
         raise RuntimeError(result.get("code", "Unknown"), result.get("message", "No message"))
     # 兼容不同返回格式
@@ -420,7 +583,7 @@ def call_qwen_text(text: str) -> dict:
         pass
     return extract_json_from_qwen(content)
 
-# 文本入账：解析自由文本中的 金额/时间/商家 并入库（启发式作为兜底）
+# 文本入账：解析自由文本中的 金额/时间/商家 并入库（明确时无需 AI）
 def normalize_time_local_from_str(raw_time: str) -> str:
     """将任意包含时间的字符串标准化为 'YYYY-MM-DD HH:MM'（Asia/Shanghai）
     规则（与截图识别一致）：
@@ -428,7 +591,7 @@ def normalize_time_local_from_str(raw_time: str) -> str:
     - 若未找到 HH:MM，则使用当前时刻（今天的当前 HH:MM）。
     """
     s = (raw_time or "").strip()
-    m_hm = re.search(r"(\d{1,2}:\d{2})", s)
+    m_hm = _HM_RE.search(s)
     if m_hm:
         return time_today_shanghai(m_hm.group(1))
     return time_today_shanghai("")
@@ -436,18 +599,18 @@ def normalize_time_local_from_str(raw_time: str) -> str:
 def parse_text_message(raw: str):
     s = (raw or "").strip()
     # 金额（支持 23.5、23,50、23 元、￥23 等）
-    m_amt = re.search(r"(-?\d+(?:[.,]\d+)?)(?:\s*(?:元|块|rmb|cny|￥))?", s, re.I)
+    m_amt = _AMOUNT_RE.search(s)
     amount = float(m_amt.group(1).replace(",", "")) if m_amt else None
 
     time_local = normalize_time_local_from_str(s)
 
     # 商家：尝试 在/于/去/给/向 之后的词块；否则取首个中文/字母串
     payee = ""
-    m_payee = re.search(r"[在于去给向]([\u4e00-\u9fa5A-Za-z0-9_\-·]{2,20})", s)
+    m_payee = _PAYEE_RE.search(s)
     if m_payee:
         payee = m_payee.group(1)
     if not payee:
-        m_cn = re.search(r"([\u4e00-\u9fa5A-Za-z]{2,20})", s)
+        m_cn = _CN_RE.search(s)
         payee = m_cn.group(1) if m_cn else ""
 
     # 分类：关键词匹配（与截图解析一致）
@@ -461,6 +624,31 @@ def parse_text_message(raw: str):
         "note": note,
     }
 
+def is_confident(data: dict, text: str) -> bool:
+    """
+    启发式结果是否足够明确、可跳过 AI：金额唯一（避免把时间里的数字当金额）、
+    商家干净（不含数字或消费动词）、分类命中关键词
+    """
+    payee = data.get("payee") or ""
+    return bool(
+        data.get("amount")
+        and payee
+        and not _PAYEE_NOISE_RE.search(payee)
+        and data.get("category") != "其他"
+        and len(_AMOUNT_RE.findall(text)) == 1
+    )
+
+def merge_ai_fields(data: dict, ai_data: dict) -> dict:
+    """用 AI 结果覆盖启发式结果，但只采用归一化后仍有效的字段（金额须非 0，文本须非空）"""
+    merged = dict(data)
+    for k, v in ai_data.items():
+        if k == "amount":
+            if clean_amount(v):
+                merged[k] = v
+        elif isinstance(v, str) and v.strip():
+            merged[k] = v.strip()
+    return merged
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not ensure_allowed(update):
         return
@@ -470,17 +658,18 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.info("User text: %s", text)
         except Exception:
             pass
-        # 1) 优先用 AI 解析
-        data = None
-        method_used = "AI 文本解析"
-        try:
-            data = call_qwen_text(text)
-        except Exception as e:
-            logger.warning(f"AI 文本解析失败，回退启发式：{e}")
-            method_used = "启发式解析"
-        # 2) 兜底启发式
-        if not isinstance(data, dict):
-            data = parse_text_message(text)
+        # 1) 先用启发式解析，结果明确时直接入账，省去一次 AI 往返
+        data = parse_text_message(text)
+        method_used = "启发式解析"
+        # 2) 不明确时再调用 AI：AI 给出的字段优先，其余沿用启发式结果
+        if not is_confident(data, text):
+            try:
+                ai_data = await asyncio.to_thread(call_qwen_text, text)
+                if isinstance(ai_data, dict):
+                    data = merge_ai_fields(data, ai_data)
+                    method_used = "AI 文本解析"
+            except Exception as e:
+                logger.warning(f"AI 文本解析失败，使用启发式结果：{e}")
 
         # 归一化与修正
         amt = clean_amount(data.get("amount"))
@@ -501,7 +690,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # 入库
         chat_id = update.effective_chat.id
         col = get_mongo()
-        doc = insert_expense(col, amt, category, payee, time_str, chat_id=chat_id)
+        doc = await insert_expense(col, amt, category, payee, time_str, chat_id=chat_id)
 
         # 回显处理方式 + 可编辑片段
         await update.message.reply_text(f"✅ 使用方式：{method_used}")
@@ -512,68 +701,85 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.exception("文本入账失败")
         await update.message.reply_text(f"❌ 文本入账失败：{e}")
 
-# /report [YYYY-MM]
+# pyplot 的全局状态不是线程安全的，并发的 /report 在线程池里绘图时需串行
+_RENDER_LOCK = threading.Lock()
+
+def render_report(month_arg: str, cat: pd.Series, daily: pd.Series, by_payee: pd.Series,
+                  df: pd.DataFrame | None, cat_png: Path, daily_png: Path, sum_xlsx: Path):
+    """
+    绘制两张图并写出汇总 Excel（CPU/磁盘密集，由 cmd_report 放到线程中执行）。
+    df 为原始明细，仅在需要 Raw 表时传入；为 None 时不写 Raw 表。
+    """
+    with _RENDER_LOCK:
+        # 两张图复用同一个 Figure，画完第一张清空坐标轴再画第二张
+        fig, ax = plt.subplots()
+        try:
+            # 图1：分类柱状图
+            cat.plot(kind="bar", ax=ax)
+            ax.set_title(f"按类别消费合计（{month_arg}）")
+            ax.set_xlabel("类别")
+            ax.set_ylabel("金额")
+            fig.tight_layout()
+            fig.savefig(cat_png, dpi=150)
+
+            # 图2：每日折线图
+            ax.clear()
+            daily.plot(kind="line", marker="o", ax=ax)
+            ax.set_title(f"每日消费折线图（{month_arg}）")
+            ax.set_xlabel("日期")
+            ax.set_ylabel("金额")
+            fig.tight_layout()
+            fig.savefig(daily_png, dpi=150)
+        finally:
+            plt.close(fig)
+
+    # 汇总 Excel（临时文件，发完即删）：
+    # xlsxwriter 只写不读，比 openpyxl 快得多；不开 constant_memory：
+    # pandas 按列写单元格，而该模式要求逐行写入，会丢数据
+    with pd.ExcelWriter(sum_xlsx, engine="xlsxwriter") as writer:
+        if df is not None:
+            raw_out = df.sort_values("Time").copy()
+            raw_out["Time"] = raw_out["Time"].dt.strftime("%Y-%m-%d %H:%M")
+            raw_out.to_excel(writer, index=False, sheet_name="Raw")
+        cat.to_frame("sum").to_excel(writer, sheet_name="ByCategory")
+        by_payee.to_frame("sum").to_excel(writer, sheet_name="ByPayee")
+        daily.to_frame("sum").to_excel(writer, sheet_name="ByDate")
+
+# /report [YYYY-MM] [raw]
 async def cmd_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not ensure_allowed(update):
         return
 
     cat_png = daily_png = sum_xlsx = None
     try:
-        sh_tz = ZoneInfo("Asia/Shanghai")
-        month_arg = " ".join(context.args) if context.args else None
+        args = context.args or []
+        # 带 raw 参数时额外附上原始明细（Raw 表），需要拉取当月全部记录
+        with_raw = any(a.lower() == "raw" for a in args)
+        month_arg = " ".join(a for a in args if a.lower() != "raw")
         if not month_arg:
-            month_arg = datetime.now(sh_tz).strftime("%Y-%m")
+            month_arg = datetime.now(_TZ_SH).strftime("%Y-%m")
 
         col = get_mongo()
-        df = load_month_df(col, month_arg, chat_id=update.effective_chat.id)
-        if df.empty:
+        chat_id = update.effective_chat.id
+        # 图表与汇总表直接使用服务端聚合结果；只有请求 Raw 表时才拉取原始记录
+        cat, daily, by_payee = await asyncio.to_thread(load_month_summary, col, month_arg, chat_id)
+        if cat.empty:
             await update.message.reply_text(f"⚠️ {month_arg} 无入账记录。")
             return
+        df = await asyncio.to_thread(load_month_df, col, month_arg, chat_id) if with_raw else None
 
-        setup_chinese_font()
-
-        # ==== 生成图表（临时文件）====
-        cat_png = REPORT_DIR / f"category_bar_{month_arg}.png"
-        daily_png = REPORT_DIR / f"daily_line_{month_arg}.png"
-        sum_xlsx = REPORT_DIR / f"summary_{month_arg}.xlsx"
-
-        # 图1：分类柱状图
-        cat = df.groupby("Category", dropna=False)["Amount"].sum().sort_values(ascending=False)
-        plt.figure()
-        ax = cat.plot(kind="bar")
-        ax.set_title(f"按类别消费合计（{month_arg}）")
-        ax.set_xlabel("类别")
-        ax.set_ylabel("金额")
-        plt.tight_layout()
-        plt.savefig(cat_png, dpi=150)
-        plt.close()
-
-        # 图2：每日折线图
-        daily = df.groupby(df["Time"].dt.date)["Amount"].sum().sort_index()
-        plt.figure()
-        ax = daily.plot(kind="line", marker="o")
-        ax.set_title(f"每日消费折线图（{month_arg}）")
-        ax.set_xlabel("日期")
-        ax.set_ylabel("金额")
-        plt.tight_layout()
-        plt.savefig(daily_png, dpi=150)
-        plt.close()
-
-        # 汇总 Excel（临时文件，发完即删）：
-        raw_out = df.sort_values("Time").copy()
-        raw_out["Time"] = raw_out["Time"].dt.strftime("%Y-%m-%d %H:%M")
-        with pd.ExcelWriter(sum_xlsx, engine="openpyxl") as writer:
-            raw_out.to_excel(writer, index=False, sheet_name="Raw")
-            cat.to_frame("sum").to_excel(writer, sheet_name="ByCategory")
-            df.groupby("Payee", dropna=False)["Amount"].sum().sort_values(ascending=False).to_frame("sum").to_excel(writer, sheet_name="ByPayee")
-            daily.to_frame("sum").to_excel(writer, sheet_name="ByDate")
+        # ==== 生成图表（临时文件；带 chat_id 避免并发报表互相覆盖）====
+        cat_png = REPORT_DIR / f"category_bar_{month_arg}_{chat_id}.png"
+        daily_png = REPORT_DIR / f"daily_line_{month_arg}_{chat_id}.png"
+        sum_xlsx = REPORT_DIR / f"summary_{month_arg}_{chat_id}.xlsx"
+        await asyncio.to_thread(render_report, month_arg, cat, daily, by_payee, df, cat_png, daily_png, sum_xlsx)
 
         with open(cat_png, "rb") as f:
-            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=f, caption=f"按类别（{month_arg}）")
+            await context.bot.send_photo(chat_id=chat_id, photo=f, caption=f"按类别（{month_arg}）")
         with open(daily_png, "rb") as f:
-            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=f, caption=f"每日合计（{month_arg}）")
+            await context.bot.send_photo(chat_id=chat_id, photo=f, caption=f"每日合计（{month_arg}）")
         with open(sum_xlsx, "rb") as f:
-            await context.bot.send_document(chat_id=update.effective_chat.id, document=f, filename=sum_xlsx.name)
+            await context.bot.send_document(chat_id=chat_id, document=f, filename=f"summary_{month_arg}.xlsx")
 
     except Exception as e:
         logger.exception("生成报表失败")
@@ -598,23 +804,25 @@ async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         limit = 20
         # 解析参数
         if len(args) >= 1:
-            if re.fullmatch(r"\d{4}-\d{2}", args[0] or ""):
+            if _YM_RE.fullmatch(args[0] or ""):
                 month = args[0]
                 if len(args) >= 2 and args[1].isdigit():
                     limit = int(args[1])
             elif args[0].isdigit():
                 limit = int(args[0])
         if not month:
-            month = datetime.now(ZoneInfo("Asia/Shanghai")).strftime("%Y-%m")
+            month = datetime.now(_TZ_SH).strftime("%Y-%m")
 
         col = get_mongo()
         chat_id = update.effective_chat.id
-        cur = col.find(
-            {"ym": month, "$or": [{"chat_id": chat_id}, {"chat_id": {"$exists": False}}]},
-            sort=[("ts_utc", -1)],
-            limit=limit
+        docs = await asyncio.to_thread(
+            lambda: list(col.find(
+                {"chat_id": chat_filter(chat_id), "ym": month},
+                projection={"_id": 1, "time_local": 1, "amount": 1, "category": 1, "payee": 1},
+                sort=[("ts_utc", -1)],
+                limit=limit
+            ))
         )
-        docs = list(cur)
         if not docs:
             await update.message.reply_text(f"⚠️ {month} 无入账记录。")
             return
@@ -630,7 +838,7 @@ async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # 解析 k=v 参数（支持用引号包裹含空格的值）
 def parse_kv_pairs(text: str) -> dict:
     pairs = {}
-    for k, v in re.findall(r'(\w+)=(".*?"|\'.*?\'|[^\s]+)', text):
+    for k, v in _KV_RE.findall(text):
         if v.startswith(("'", '"')) and v.endswith(("'", '"')):
             v = v[1:-1]
         pairs[k.lower()] = v
@@ -665,15 +873,6 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ 存在不支持字段：{', '.join(unknown)}")
             return
 
-        col = get_mongo()
-        chat_id = update.effective_chat.id
-
-        # 取原始文档（限定 chat）
-        old = col.find_one({"_id": _id, "$or": [{"chat_id": chat_id}, {"chat_id": {"$exists": False}}]})
-        if not old:
-            await update.message.reply_text("❌ 未找到该记录（或不属于当前会话）。")
-            return
-
         set_doc = {}
         if "amount" in updates:
             set_doc["amount"] = clean_amount(updates["amount"])
@@ -697,14 +896,20 @@ async def cmd_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ 没有可更新的内容。")
             return
 
-        new_doc = col.find_one_and_update(
-            {"_id": _id, "$or": [{"chat_id": chat_id}, {"chat_id": {"$exists": False}}]},
+        col = get_mongo()
+        chat_id = update.effective_chat.id
+
+        # 一次往返：原子更新并取回更新前的文档（限定 chat），新文档在本地合成
+        old = await asyncio.to_thread(
+            col.find_one_and_update,
+            {"_id": _id, "chat_id": chat_filter(chat_id)},
             {"$set": set_doc},
-            return_document=ReturnDocument.AFTER
+            return_document=ReturnDocument.BEFORE
         )
-        if not new_doc:
-            await update.message.reply_text("❌ 更新失败。")
+        if not old:
+            await update.message.reply_text("❌ 未找到该记录（或不属于当前会话）。")
             return
+        new_doc = {**old, **set_doc}
 
         await update.message.reply_text(
             "✅ 已更新：\n"
@@ -742,7 +947,7 @@ async def cmd_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         deleted = 0
         not_found = 0
         for oid in ids:
-            res = col.delete_one({"_id": oid, "$or": [{"chat_id": chat_id}, {"chat_id": {"$exists": False}}]})
+            res = await asyncio.to_thread(col.delete_one, {"_id": oid, "chat_id": chat_filter(chat_id)})
             if res.deleted_count == 1:
                 deleted += 1
             else:
@@ -766,7 +971,13 @@ def main():
     if not MONGO_URI:
         raise RuntimeError("MONGO_URI 未配置")
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # 启动时即建立连接并确保索引，处理消息时不再触发
+    get_mongo()
+    # 字体扫描只需一次，结果写入 rcParams 后对所有报表生效
+    setup_chinese_font()
+
+    # 允许并发处理不同消息：阻塞调用均已放到线程中，不会卡住事件循环
+    app = ApplicationBuilder().token(TELEGRAM_TOKEN).concurrent_updates(True).build()
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     app.add_handler(CommandHandler("report", cmd_report))